@@ -0,0 +1,35 @@
+"""add deleted_at to posts for background deletion
+
+Revision ID: 10133d90c2e0
+Revises: e9c79ee20c3e
+Create Date: 2026-10-19 09:12:31.204518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '10133d90c2e0'
+down_revision: Union[str, None] = 'e9c79ee20c3e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("posts", sa.Column("deleted_at", sa.TIMESTAMP(timezone=True), nullable=True))
+    # Only posts waiting to be purged are in this index, so the purge worker finds them without a scan
+    op.create_index("ix_posts_pending_delete", "posts", ["deleted_at"],
+                    postgresql_where=sa.text("deleted_at IS NOT NULL"))
+    # The votes primary key is (user_id, post_id), which doesn't help when looking up a post's votes
+    op.create_index("ix_votes_post_id", "votes", ["post_id"])
+    pass
+
+
+def downgrade() -> None:
+    op.drop_index("ix_votes_post_id", table_name="votes")
+    op.drop_index("ix_posts_pending_delete", table_name="posts")
+    op.drop_column("posts", "deleted_at")
+    pass
@@ -0,0 +1,28 @@
+"""add version to posts for optimistic concurrency
+
+Revision ID: 5b1e0a7c93d4
+Revises: 10133d90c2e0
+Create Date: 2026-10-19 10:03:58.771240
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b1e0a7c93d4'
+down_revision: Union[str, None] = '10133d90c2e0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("posts", sa.Column("version", sa.Integer(), nullable=False, server_default="1"))
+    pass
+
+
+def downgrade() -> None:
+    op.drop_column("posts", "version")
+    pass
@@ -0,0 +1,143 @@
+"""partition posts by created_at
+
+Revision ID: 8c4f2d6e1a90
+Revises: 5b1e0a7c93d4
+Create Date: 2026-10-19 11:20:44.915302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c4f2d6e1a90'
+down_revision: Union[str, None] = '5b1e0a7c93d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# NOTES:
+# - Turns posts into a table partitioned by month of created_at (posts_2024_08, posts_2024_09, ...). Queries
+#   that filter on created_at only have to look at the partitions that can match ('partition pruning'), and
+#   old months can be detached and archived without touching the rest. See app/partitions.py.
+# - Postgres needs the partition key in the primary key, so the PK becomes (id, created_at). ids still come
+#   from the same sequence, so they stay unique.
+# - A foreign key has to point at a unique key, so votes gets a post_created_at column and the FK becomes
+#   (post_id, post_created_at) -> posts (id, created_at), still ON DELETE CASCADE.
+# - create_posts_partitions(start, months_ahead) creates any missing monthly partitions from start up to
+#   months_ahead months from now. The app calls it on startup and once a day.
+# - This copies every post in one transaction. On a really big table, do the copy in batches instead.
+
+CREATE_PARTITIONS_FUNCTION = """
+CREATE OR REPLACE FUNCTION create_posts_partitions(start_at timestamptz, months_ahead integer)
+RETURNS integer AS $$
+DECLARE
+    month_start date := date_trunc('month', start_at)::date;
+    last_month date := (date_trunc('month', now()) + make_interval(months => months_ahead))::date;
+    partition_name text;
+    created integer := 0;
+BEGIN
+    WHILE month_start <= last_month LOOP
+        partition_name := format('posts_%s', to_char(month_start, 'YYYY_MM'));
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF posts FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, month_start, (month_start + interval '1 month')::date);
+            created := created + 1;
+        END IF;
+        month_start := (month_start + interval '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE posts RENAME TO posts_old")
+    op.execute("ALTER INDEX posts_pkey RENAME TO posts_old_pkey")
+    op.execute("DROP INDEX ix_posts_pending_delete")
+
+    op.execute("""
+        CREATE TABLE posts (
+            id integer NOT NULL DEFAULT nextval('posts_id_seq'),
+            user_id integer NOT NULL,
+            title varchar NOT NULL,
+            content varchar NOT NULL,
+            published boolean NOT NULL DEFAULT true,
+            created_at timestamptz NOT NULL DEFAULT now(),
+            deleted_at timestamptz,
+            version integer NOT NULL DEFAULT 1,
+            CONSTRAINT posts_pkey PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute(CREATE_PARTITIONS_FUNCTION)
+    op.execute("SELECT create_posts_partitions(coalesce(min(created_at), now()), 3) FROM posts_old")
+    op.execute("""
+        INSERT INTO posts (id, user_id, title, content, published, created_at, deleted_at, version)
+        SELECT id, user_id, title, content, published, created_at, deleted_at, version FROM posts_old
+    """)
+
+    op.add_column("votes", sa.Column("post_created_at", sa.TIMESTAMP(timezone=True), nullable=True))
+    op.execute("UPDATE votes SET post_created_at = p.created_at FROM posts_old p WHERE p.id = votes.post_id")
+    op.alter_column("votes", "post_created_at", nullable=False)
+    op.drop_constraint("votes_post_id_fkey", table_name="votes")
+
+    # The sequence belongs to posts_old.id, and would be dropped along with it
+    op.execute("ALTER SEQUENCE posts_id_seq OWNED BY posts.id")
+    op.drop_table("posts_old")
+
+    op.create_foreign_key("post_users_fk", source_table="posts", referent_table="users",
+                          local_cols=["user_id"], remote_cols=["id"], ondelete="CASCADE")
+    op.create_foreign_key("votes_post_fk", source_table="votes", referent_table="posts",
+                          local_cols=["post_id", "post_created_at"], remote_cols=["id", "created_at"],
+                          ondelete="CASCADE")
+    op.create_index("ix_posts_created_at", "posts", [sa.text("created_at DESC"), sa.text("id DESC")])
+    op.create_index("ix_posts_pending_delete", "posts", ["deleted_at"],
+                    postgresql_where=sa.text("deleted_at IS NOT NULL"))
+
+    # Votes on posts in a detached partition are moved here, see app/partitions.py
+    op.create_table("votes_archive",
+                    sa.Column("user_id", sa.Integer(), nullable=False),
+                    sa.Column("post_id", sa.Integer(), nullable=False),
+                    sa.Column("post_created_at", sa.TIMESTAMP(timezone=True), nullable=False))
+    pass
+
+
+def downgrade() -> None:
+    # NOTE: only brings back posts in partitions that are still attached
+    op.drop_table("votes_archive")
+    op.drop_constraint("votes_post_fk", table_name="votes")
+
+    op.execute("ALTER TABLE posts RENAME TO posts_partitioned")
+    op.execute("ALTER INDEX posts_pkey RENAME TO posts_partitioned_pkey")
+    op.execute("ALTER INDEX ix_posts_pending_delete RENAME TO ix_posts_partitioned_pending_delete")
+    op.create_table("posts",
+                    sa.Column("id", sa.Integer(), server_default=sa.text("nextval('posts_id_seq')"),
+                              nullable=False),
+                    sa.Column("user_id", sa.Integer(), nullable=False),
+                    sa.Column("title", sa.String(), nullable=False),
+                    sa.Column("content", sa.String(), nullable=False),
+                    sa.Column("published", sa.Boolean(), server_default="TRUE", nullable=False),
+                    sa.Column("created_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()"),
+                              nullable=False),
+                    sa.Column("deleted_at", sa.TIMESTAMP(timezone=True), nullable=True),
+                    sa.Column("version", sa.Integer(), server_default="1", nullable=False),
+                    sa.PrimaryKeyConstraint("id", name="posts_pkey"))
+    op.execute("""
+        INSERT INTO posts (id, user_id, title, content, published, created_at, deleted_at, version)
+        SELECT id, user_id, title, content, published, created_at, deleted_at, version FROM posts_partitioned
+    """)
+    op.execute("ALTER SEQUENCE posts_id_seq OWNED BY posts.id")
+    op.execute("DROP TABLE posts_partitioned CASCADE") # takes the attached partitions with it
+    op.execute("DROP FUNCTION create_posts_partitions(timestamptz, integer)")
+
+    op.create_foreign_key("post_users_fk", source_table="posts", referent_table="users",
+                          local_cols=["user_id"], remote_cols=["id"], ondelete="CASCADE")
+    op.create_index("ix_posts_pending_delete", "posts", ["deleted_at"],
+                    postgresql_where=sa.text("deleted_at IS NOT NULL"))
+    op.execute("DELETE FROM votes WHERE post_id NOT IN (SELECT id FROM posts)")
+    op.create_foreign_key("votes_post_id_fkey", source_table="votes", referent_table="posts",
+                          local_cols=["post_id"], remote_cols=["id"], ondelete="CASCADE")
+    op.drop_column("votes", "post_created_at")
+    pass
@@ -0,0 +1,59 @@
+"""add follows and timelines
+
+Revision ID: f3a9c1b7d248
+Revises: 8c4f2d6e1a90
+Create Date: 2026-10-19 14:41:09.530127
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a9c1b7d248'
+down_revision: Union[str, None] = '8c4f2d6e1a90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("users", sa.Column("follower_count", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("users", sa.Column("fanout_on_read", sa.Boolean(), nullable=False, server_default="FALSE"))
+    op.create_index("ix_users_fanout_on_read", "users", ["id"], postgresql_where=sa.text("fanout_on_read"))
+
+    op.create_table("follows",
+                    sa.Column("follower_id", sa.Integer(), nullable=False),
+                    sa.Column("followee_id", sa.Integer(), nullable=False),
+                    sa.Column("created_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()"),
+                              nullable=False),
+                    sa.ForeignKeyConstraint(["follower_id"], ["users.id"], ondelete="CASCADE"),
+                    sa.ForeignKeyConstraint(["followee_id"], ["users.id"], ondelete="CASCADE"),
+                    sa.PrimaryKeyConstraint("follower_id", "followee_id"))
+    op.create_index("ix_follows_followee_id", "follows", ["followee_id", "follower_id"])
+
+    op.create_table("timelines",
+                    sa.Column("user_id", sa.Integer(), nullable=False),
+                    sa.Column("post_created_at", sa.TIMESTAMP(timezone=True), nullable=False),
+                    sa.Column("post_id", sa.Integer(), nullable=False),
+                    sa.Column("author_id", sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+                    sa.ForeignKeyConstraint(["post_id", "post_created_at"], ["posts.id", "posts.created_at"],
+                                            name="timelines_post_fk", ondelete="CASCADE"),
+                    sa.PrimaryKeyConstraint("user_id", "post_created_at", "post_id"))
+    op.create_index("ix_timelines_post", "timelines", ["post_id", "post_created_at"])
+
+    op.create_index("ix_posts_user_id_created_at", "posts",
+                    ["user_id", sa.text("created_at DESC"), sa.text("id DESC")])
+    pass
+
+
+def downgrade() -> None:
+    op.drop_index("ix_posts_user_id_created_at", table_name="posts")
+    op.drop_table("timelines")
+    op.drop_table("follows")
+    op.drop_index("ix_users_fanout_on_read", table_name="users")
+    op.drop_column("users", "fanout_on_read")
+    op.drop_column("users", "follower_count")
+    pass
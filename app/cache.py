@@ -0,0 +1,178 @@
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+import threading
+import time
+from . import models
+from .config import settings
+
+# Small in-process caches. Our sync routes run in a threadpool, so everything in here has to be
+# thread safe. Each worker process keeps its own copy, nothing is shared between processes.
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Bounded least-recently-used mapping. When it is full, the entry that was used longest ago is evicted."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class GenerationCache:
+    """Cache of query results that all go stale together.
+
+    Every entry remembers the generation it was computed in. bump() moves to a new generation, which makes
+    every existing entry stale in one step, without having to work out which keys a write affected.
+    Stale entries are still served for up to stale_seconds after they were computed, if that's set, and
+    nothing is served after ttl_seconds. When several threads miss on the same key at once, only one of
+    them runs the query (single flight) and the others wait for its result, for up to wait_seconds. After
+    that they give up on it and run the query themselves.
+    """
+
+    def __init__(self, maxsize: int, stale_seconds: float = 0, ttl_seconds: float = 60, wait_seconds: float = 5):
+        self.stale_seconds = stale_seconds
+        self.ttl_seconds = ttl_seconds
+        self.wait_seconds = wait_seconds
+        self._entries = LRUCache(maxsize)
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._in_flight = {} # key -> _Flight
+
+    def bump(self):
+        with self._lock:
+            self._generation += 1
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        generation, computed_at, value = entry
+        age = time.monotonic() - computed_at
+        if age > self.ttl_seconds:
+            return _MISSING
+        if generation == self._generation or age <= self.stale_seconds:
+            return value
+        return _MISSING
+
+    def get_or_compute(self, key, compute, before_wait=None):
+        """before_wait is called before waiting on another thread's query. Pass db.commit, so a waiting
+        request hands its connection back to the pool instead of sitting on it."""
+
+        value = self._fresh(key)
+        if value is not _MISSING:
+            return value
+
+        with self._lock:
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _Flight()
+            # Read before running the query: if a write bumps the generation while we're querying, what we
+            # store is already stale, which is what we want
+            generation = self._generation
+
+        if not leader:
+            if before_wait is not None:
+                before_wait()
+            if not flight.done.wait(self.wait_seconds):
+                return compute() # the leader is taking too long, don't hang on it
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+            self._entries.set(key, (generation, time.monotonic(), flight.value))
+            return flight.value
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            flight.done.set()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+# ----------------------------------------------------------------------------------------------------
+
+# POSTS LISTING CACHE
+
+# The first pages of GET /posts, keyed on the normalized query parameters. create_posts, update_post,
+# delete_post and vote all call posts_cache.bump() after they commit.
+# NOTE: like everything in here this is per process. Writes handled by another process don't bump this
+# one's generation, which is what ttl_seconds is for.
+posts_cache = GenerationCache(settings.posts_cache_size, stale_seconds=settings.posts_cache_stale_seconds,
+                              ttl_seconds=settings.posts_cache_ttl_seconds,
+                              wait_seconds=settings.posts_cache_wait_seconds)
+
+# ----------------------------------------------------------------------------------------------------
+
+# USER CACHE
+
+# UserOut records by user id, so that looking up post authors usually doesn't touch the database. We drop a
+# user from the cache whenever the ORM updates or deletes that row, so the next lookup reads it again.
+# - The update/delete events fire when the change is flushed, which is BEFORE it's committed. A lookup from
+#   another request in between would still read the old row and put it straight back in the cache, and
+#   nothing would ever take it out again. So we drop the user at flush time, remember the id on the Session,
+#   and drop it again once the commit has happened.
+# NOTE: bulk query.update()/query.delete() calls skip these ORM events, so invalidate by hand after those.
+user_cache = LRUCache(settings.user_cache_size)
+
+
+@event.listens_for(models.User, 'after_update')
+@event.listens_for(models.User, 'after_delete')
+def invalidate_user(mapper, connection, target):
+    user_cache.pop(target.id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_user_ids', set()).add(target.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed_users(session):
+    for id in session.info.pop('changed_user_ids', ()):
+        user_cache.pop(id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_rolled_back_users(session, previous_transaction):
+    # Nothing changed in the database, so there's nothing left to drop
+    session.info.pop('changed_user_ids', None)
@@ -0,0 +1,66 @@
+"""Recommend a bcrypt cost (BCRYPT_ROUNDS) for a target login latency on this machine.
+
+Run it on the same kind of host that serves the API, since the answer depends on the CPU:
+
+    python -m app.calibrate_bcrypt
+    python -m app.calibrate_bcrypt --target-ms 100
+
+Each extra round doubles the hashing time, so we time a cheap cost, estimate where the target falls, then
+time the rounds around the estimate to confirm it. Doesn't need the database or a .env file.
+
+"""
+import argparse
+import math
+import time
+
+from passlib.hash import bcrypt
+
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+
+
+def time_hash(rounds: int, samples: int = 3):
+    """Best-of-n time (in ms) to hash a password at the given cost."""
+
+    hasher = bcrypt.using(rounds=rounds)
+    best = math.inf
+    for _ in range(samples):
+        start = time.perf_counter()
+        hasher.hash('calibration-password')
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def recommend_rounds(target_ms: float, samples: int = 3):
+    """Highest cost whose hash time stays at or under target_ms. Returns (rounds, {rounds: ms measured})."""
+
+    base_rounds = 8
+    time_hash(MIN_ROUNDS, 1) # warm up, the very first hash also pays for loading the backend
+    base_ms = time_hash(base_rounds, samples)
+    estimate = base_rounds + math.floor(math.log2(target_ms / base_ms))
+    estimate = max(MIN_ROUNDS, min(MAX_ROUNDS, estimate))
+
+    timings = {base_rounds: base_ms}
+    for rounds in range(max(MIN_ROUNDS, estimate - 1), min(MAX_ROUNDS, estimate + 1) + 1):
+        timings.setdefault(rounds, time_hash(rounds, samples))
+
+    under_target = [rounds for rounds, ms in timings.items() if ms <= target_ms]
+    return (max(under_target) if under_target else MIN_ROUNDS), timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target-ms', type=float, default=250,
+                        help='how long one hash (i.e. one login) may spend in bcrypt, in milliseconds')
+    parser.add_argument('--samples', type=int, default=3, help='hashes timed per cost, the fastest one counts')
+    args = parser.parse_args()
+
+    rounds, timings = recommend_rounds(args.target_ms, args.samples)
+
+    for measured_rounds in sorted(timings):
+        print(f'rounds {measured_rounds:>2}: {timings[measured_rounds]:8.1f} ms')
+    print(f'\nrecommended for a {args.target_ms:g} ms target: BCRYPT_ROUNDS={rounds}')
+
+
+if __name__ == '__main__':
+    main()
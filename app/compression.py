@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+
+import brotli
+from starlette.datastructures import Headers, MutableHeaders
+
+from .cache import LRUCache
+
+# NOTES:
+# - Our post listings are big JSON bodies, and JSON is very repetitive text (the same keys on every post),
+#   so it compresses really well. This middleware compresses the body if the client says it can handle
+#   it in the Accept-Encoding header. Brotli ('br') compresses better than gzip, so we prefer it.
+# - Compressing costs CPU on every request. A lot of our responses are byte-for-byte the same as the last
+#   time (the same single post, the first page of the feed), so we keep the compressed bytes in a small LRU
+#   cache keyed by a hash of the uncompressed body. Hashing is much cheaper than compressing again.
+#   Only GET 200 bodies up to cache_max_body_size go in the cache, and not the ones under uncached_prefixes:
+#   responses that are different for every caller (like the home feed) would push everything else out of
+#   the cache and never be asked for again.
+# - Streaming responses (more than one body chunk) are passed through untouched.
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/', 'application/javascript', 'application/xml')
+
+
+def negotiate_encoding(accept_encoding: str):
+    """Pick 'br' or 'gzip' from an Accept-Encoding header value, or None if the client accepts neither.
+    The one with the higher q-value wins, br on a tie."""
+
+    accepted = {}
+    for part in accept_encoding.split(','):
+        token, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token.strip().lower()] = quality
+
+    wildcard = accepted.get('*', 0.0)
+    br, gzip_ = accepted.get('br', wildcard), accepted.get('gzip', wildcard)
+    if br <= 0 and gzip_ <= 0:
+        return None
+    return 'br' if br >= gzip_ else 'gzip'
+
+
+class CompressionMiddleware:
+
+    def __init__(self, app, minimum_size: int = 500, gzip_level: int = 6, brotli_quality: int = 4,
+                 cache_size: int = 256, cache_max_body_size: int = 256 * 1024, uncached_prefixes=()):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache = LRUCache(cache_size)
+        self.cache_max_body_size = cache_max_body_size
+        self.uncached_prefixes = tuple(uncached_prefixes)
+
+    def cacheable(self, scope, status: int, body: bytes):
+        return (scope['method'] == 'GET' and status == 200 and len(body) <= self.cache_max_body_size
+                and not (self.uncached_prefixes and scope['path'].startswith(self.uncached_prefixes)))
+
+    def compress(self, body: bytes, encoding: str, cacheable: bool = False):
+        key = None
+        if cacheable:
+            key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+            compressed = self.cache.get(key)
+            if compressed is not None:
+                return compressed
+
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(body, compresslevel=self.gzip_level)
+
+        if key is not None:
+            self.cache.set(key, compressed)
+        return compressed
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        # We hold back the response start message until we've seen the body, because we can only set the
+        # Content-Encoding and Content-Length headers once we know whether we're compressing.
+        start_message = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+
+            if message['type'] == 'http.response.start':
+                start_message = message
+                return
+
+            if message['type'] != 'http.response.body' or passthrough:
+                await send(message)
+                return
+
+            start, start_message = start_message, None
+            body = message.get('body', b'')
+            headers = MutableHeaders(raw=start['headers'])
+            content_type = headers.get('content-type', '')
+
+            if (message.get('more_body', False) or len(body) < self.minimum_size
+                    or 'content-encoding' in headers or not content_type.startswith(COMPRESSIBLE_TYPES)):
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+
+            compressed = self.compress(body, encoding, self.cacheable(scope, start['status'], body))
+
+            headers['Content-Encoding'] = encoding
+            headers['Content-Length'] = str(len(compressed))
+            headers.add_vary_header('Accept-Encoding')
+            await send(start)
+            await send({'type': 'http.response.body', 'body': compressed})
+
+        await self.app(scope, receive, send_wrapper)
+
+        # Responses that never sent a body still need their start message to go out
+        if start_message is not None:
+            await send(start_message)
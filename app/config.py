@@ -10,8 +10,69 @@ class Settings(BaseSettings):
     algorithm: str
     access_token_expire_minutes: int
 
+    # Response compression. Bodies smaller than the minimum size aren't worth the CPU (and can even get
+    # bigger once compressed). Level trades CPU for bandwidth, see benchmarks/compression_bench.py.
+    compression_minimum_size: int = 500
+    compression_level: int = 6 # gzip, 1-9
+    compression_brotli_quality: int = 4 # brotli, 0-11
+    compression_cache_size: int = 256
+    # Bodies bigger than this are still compressed, just not kept in the cache, so a few huge pages can't
+    # take up all of its memory
+    compression_cache_max_body_size: int = 256 * 1024
+
+    # Batch user lookups (GET /users?ids=1,2,3) and the in-process cache of UserOut records behind them
+    user_batch_max_ids: int = 100
+    user_cache_size: int = 10000
+
+    # bcrypt cost factor for password hashes. Pick it with 'python -m app.calibrate_bcrypt'. Changing it is
+    # safe: stored hashes get rehashed to the new cost the next time each user logs in.
+    bcrypt_rounds: int = 12
+
+    # Deleted posts are purged in the background: votes go in chunks of this many rows, one transaction each
+    purge_chunk_size: int = 1000
+    purge_interval_seconds: float = 30
+
+    # posts is partitioned by month. Keep this many months of empty partitions created ahead of time.
+    posts_partition_months_ahead: int = 3
+    # GET /posts only looks at posts this recent by default, so Postgres can skip the older partitions
+    feed_max_age_days: int = 90
+
+    # Live vote counts over the /posts/stream websocket: at most one update per post per interval
+    stream_interval_seconds: float = 1.0
+    stream_max_posts_per_client: int = 200
+
+    # Slow query log (look in database.py). EXPLAIN ANALYZE runs the query a second time, so it's opt in.
+    slow_query_log: bool = True
+    slow_query_ms: float = 500
+    slow_query_max_per_minute: int = 30
+    slow_query_explain: bool = False
+    slow_query_explain_cooldown_seconds: float = 600
+
+    # Cache of the first pages of GET /posts (look in cache.py). Pages past posts_cache_max_skip, or bigger
+    # than posts_cache_max_limit, aren't cached.
+    # Set stale_seconds above 0 to keep serving a page for that long after a write instead of requerying.
+    posts_cache_size: int = 512
+    posts_cache_max_skip: int = 100
+    posts_cache_max_limit: int = 100
+    posts_cache_stale_seconds: float = 0
+    posts_cache_ttl_seconds: float = 60
+    # How long a request waits for another request that is already running the same page's query
+    posts_cache_wait_seconds: float = 5
+
+    # Sampling profiler (look in profiling.py). Off unless the sample rate is above 0 or the header is allowed.
+    profile_sample_rate: float = 0.0
+    profile_debug_header: bool = False
+    profile_interval_ms: float = 5
+
+    # Home feeds. Authors with at least this many followers stop getting their posts copied into every
+    # follower's timeline, their followers read them straight from posts instead (look in feeds.py).
+    fanout_on_read_threshold: int = 10000
+    # How many of an author's latest posts go into your timeline when you follow them
+    follow_backfill_posts: int = 50
+    feed_max_limit: int = 100
+
     # To tell Pydantic to import from .env file
     class Config:
         env_file = '.env'
 
-settings = Settings()
\ No newline at end of file
+settings = Settings()
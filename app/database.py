@@ -1,10 +1,15 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from .config import settings
 
 import psycopg2 # default postgres driver
 from psycopg2.extras import RealDictCursor
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+import logging
+import re
+import threading
 import time
 
 SQLALCHEMY_DATABASE_URL = f'''postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}'''
@@ -14,10 +19,16 @@ engine = create_engine(SQLALCHEMY_DATABASE_URL)
 # If you are using sqlite, add another argument to the above: connect_args={'check_same_thread':False}
 # This is not needed for postgres.
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: objects stay readable after commit without going back to the database. The
+# routers end each request's transaction as soon as the endpoint returns (look in routing.py) and rely on
+# this so that turning the returned objects into JSON doesn't need a connection again.
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 Base = declarative_base()
 
+# Creating a Session doesn't touch the database. It only checks a connection out of the pool when it runs
+# its first query, and gives it back when that transaction ends, which AppRoute makes happen right after
+# the endpoint returns. Closing here is the safety net for anything that ran after that.
 def get_db():
     db = SessionLocal()
     try:
@@ -25,6 +36,145 @@ def get_db():
     finally:
         db.close()
 
+# ----------------------------------------------------------------------------------------------------
+
+# SLOW QUERY LOG
+# - Every statement the engine runs is timed. Anything slower than settings.slow_query_ms is logged to the
+#   'app.slow_queries' logger with the route that ran it, the SQL (normalized, so the same query with
+#   different values looks the same), and the bind parameters.
+# - With settings.slow_query_explain on, we also run EXPLAIN (ANALYZE, BUFFERS) on the same SELECT with the
+#   same parameters, on a background thread so the request doesn't wait for it. ANALYZE really runs the
+#   query, which is why we only do it for SELECTs, and only once per normalized statement per cooldown.
+# - Logging is rate limited (settings.slow_query_max_per_minute), so a bad deploy that makes every query
+#   slow can't flood the logs. That's what makes it OK to leave this on in production.
+
+slow_query_logger = logging.getLogger('app.slow_queries')
+
+# The ASGI scope of the request being handled. Sync routes run in a threadpool, but FastAPI copies the
+# context into the worker thread, so the query hooks below can still see which request they belong to.
+current_request_scope = ContextVar('current_request_scope', default=None)
+
+
+class RequestScopeMiddleware:
+    """Remembers the current request's scope in current_request_scope, for the slow query log."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Not the lifespan scope: tasks started at startup (like the vote broker) would inherit it, and it
+        # has no path to log
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+
+        token = current_request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_request_scope.reset(token)
+
+
+def current_route():
+    scope = current_request_scope.get()
+    if scope is None:
+        return 'background'
+    # The router puts the matched route into the scope, so we can log /posts/{id} rather than /posts/123
+    route = scope.get('route')
+    return f"{scope.get('method', 'WS')} {route.path if route is not None else scope.get('path', '?')}"
+
+
+def normalize_sql(statement: str):
+    statement = re.sub(r"'(?:[^']|'')*'", '?', statement) # string literals
+    statement = re.sub(r'\b\d+(?:\.\d+)?\b', '?', statement) # number literals
+    statement = re.sub(r'IN \((?:[^()]|\([^()]*\))*\)', 'IN (...)', statement) # IN lists of any length
+    return ' '.join(statement.split())
+
+
+def redact_parameters(parameters):
+    if isinstance(parameters, dict):
+        return {name: '***' if 'password' in name else (repr(value)[:200])
+                for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)): # executemany
+            return [redact_parameters(row) for row in parameters[:5]]
+        return [repr(value)[:200] for value in parameters]
+    return parameters
+
+
+class RateLimiter:
+    """Token bucket: allows per_minute events a minute, in bursts of up to per_minute."""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.per_minute, self._tokens + (now - self._updated) * self.per_minute / 60)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+slow_query_limiter = RateLimiter(settings.slow_query_max_per_minute)
+explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slow-query-explain')
+explained_at = {} # normalized statement -> when we last ran EXPLAIN for it
+explained_lock = threading.Lock()
+
+
+def explain_slow_query(statement: str, parameters, normalized: str):
+    try:
+        # slow_query_log=False stops the EXPLAIN itself being timed and logged by the hooks below
+        with engine.connect().execution_options(slow_query_log=False) as conn:
+            transaction = conn.begin()
+            try:
+                plan = conn.exec_driver_sql('EXPLAIN (ANALYZE, BUFFERS) ' + statement, parameters).scalars().all()
+            finally:
+                transaction.rollback()
+        slow_query_logger.warning('plan for slow query: %s\n%s', normalized, '\n'.join(plan))
+    except Exception:
+        slow_query_logger.exception('EXPLAIN of slow query failed: %s', normalized)
+
+
+def should_explain(statement: str, normalized: str):
+    if not settings.slow_query_explain or not statement.lstrip().upper().startswith('SELECT'):
+        return False
+    now = time.monotonic()
+    with explained_lock:
+        if now - explained_at.get(normalized, -settings.slow_query_explain_cooldown_seconds) \
+                < settings.slow_query_explain_cooldown_seconds:
+            return False
+        explained_at[normalized] = now
+        return True
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+@event.listens_for(engine, 'after_cursor_execute')
+def log_slow_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - context._query_started) * 1000
+    if (elapsed_ms < settings.slow_query_ms or not settings.slow_query_log
+            or context.execution_options.get('slow_query_log') is False):
+        return
+    if not slow_query_limiter.allow():
+        return
+
+    normalized = normalize_sql(statement)
+    slow_query_logger.warning('slow query (%.0f ms) from %s: %s params=%s', elapsed_ms, current_route(),
+                              normalized, redact_parameters(parameters))
+
+    if not executemany and should_explain(statement, normalized):
+        explain_executor.submit(explain_slow_query, statement, parameters, normalized)
+
 
 # CONNECTING TO SQL DIRECTLY RATHER THAN USING ORM LIKE SQLALCHEMY
 
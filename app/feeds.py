@@ -0,0 +1,163 @@
+import base64
+from datetime import datetime
+from fastapi import HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import TIMESTAMP, delete, func, insert, literal, select, tuple_, union_all, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+from . import models
+from .cache import GenerationCache
+from .config import settings
+
+# AUTHOR TIMELINES AND HOME FEEDS
+# - Both are paginated with a CURSOR instead of skip: the response has a next_cursor, and you pass it back
+#   as ?cursor= to get the next page. The cursor is the (created_at, id) of the last post you got, and the
+#   next page is 'posts older than that', which Postgres answers by continuing down an index. With skip it
+#   would have to read and throw away every post before the page.
+# - An author's timeline uses the (user_id, created_at, id) index on posts.
+# - FAN-OUT ON WRITE: when someone posts, create_posts copies a (follower, post) row into the timelines
+#   table for each of their followers. A home feed page is then one range scan of the timelines primary key.
+# - FAN-OUT ON READ: for an author with a huge number of followers that copy would be far too slow, so
+#   once they reach settings.fanout_on_read_threshold we stop copying their posts. Home feeds read those
+#   few authors' latest posts straight from posts (one short index range scan each) and merge them in.
+
+
+def encode_cursor(created_at: datetime, id: int):
+    return base64.urlsafe_b64encode(f'{created_at.isoformat()}|{id}'.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='Invalid cursor')
+
+
+def posts_with_votes(db: Session, keys):
+    """The posts with the given (created_at, id) keys, in that order, each with its vote count. Deleted
+    posts are left out. Uses created_at too, so only the partitions those posts are in get looked at."""
+
+    if not keys:
+        return []
+
+    results = db.query(models.Post, func.count(models.Vote.post_id).label("votes"))\
+        .join(models.Vote, models.Vote.post_id == models.Post.id, isouter=True)\
+        .filter(tuple_(models.Post.created_at, models.Post.id).in_(keys), models.Post.deleted_at.is_(None))\
+        .group_by(models.Post.id, models.Post.created_at).all()
+
+    order = {id: position for position, (created_at, id) in enumerate(keys)}
+    return sorted(results, key=lambda result: order[result.Post.id])
+
+
+def page(results, keys, limit: int):
+    # A full page of keys means there may be more. We continue from the last KEY rather than the last post
+    # returned, so a deleted post at the end of the page doesn't send us back over the same posts.
+    next_cursor = encode_cursor(*keys[-1]) if len(keys) == limit else None
+    return {"posts": jsonable_encoder(results), "next_cursor": next_cursor}
+
+
+def author_post_keys(author_id: int, limit: int, before=None):
+    query = select(models.Post.created_at, models.Post.id)\
+        .where(models.Post.user_id == author_id, models.Post.deleted_at.is_(None))
+    if before is not None:
+        query = query.where(tuple_(models.Post.created_at, models.Post.id) < tuple_(*before))
+    return query.order_by(models.Post.created_at.desc(), models.Post.id.desc()).limit(limit)
+
+
+def author_timeline(db: Session, author_id: int, limit: int, cursor: str = None):
+    before = decode_cursor(cursor) if cursor else None
+    keys = [tuple(key) for key in db.execute(author_post_keys(author_id, limit, before)).all()]
+    return page(posts_with_votes(db, keys), keys, limit)
+
+# ----------------------------------------------------------------------------------------------------
+
+# The ids of every fanout_on_read user. There are only ever a few of them (it takes a lot of followers), and
+# a user only joins the list, never leaves it, so it's fine for this to be up to a minute out of date.
+fanout_on_read_users = GenerationCache(1, ttl_seconds=60)
+
+
+def get_fanout_on_read_users(db: Session):
+    return fanout_on_read_users.get_or_compute('ids', lambda: db.execute(
+        select(models.User.id).where(models.User.fanout_on_read)).scalars().all(), before_wait=db.commit)
+
+
+def home_feed(db: Session, user_id: int, limit: int, cursor: str = None):
+    before = decode_cursor(cursor) if cursor else None
+
+    # Posts that were fanned out to us when they were written: a range scan of our part of timelines
+    timeline_keys = select(models.Timeline.post_created_at, models.Timeline.post_id)\
+        .where(models.Timeline.user_id == user_id)
+    if before is not None:
+        timeline_keys = timeline_keys.where(
+            tuple_(models.Timeline.post_created_at, models.Timeline.post_id) < tuple_(*before))
+    timeline_keys = timeline_keys.order_by(models.Timeline.post_created_at.desc(),
+                                           models.Timeline.post_id.desc()).limit(limit)
+    queries = [timeline_keys]
+
+    # Plus the latest posts of the fanout_on_read authors we follow. Checked by primary key against that
+    # short list of users, not by going through everyone we follow.
+    big_authors = get_fanout_on_read_users(db)
+    if big_authors:
+        followed = db.execute(select(models.Follow.followee_id).where(
+            models.Follow.follower_id == user_id, models.Follow.followee_id.in_(big_authors))).scalars().all()
+        queries += [author_post_keys(author_id, limit, before) for author_id in followed]
+
+    # Each part is already limited and sorted by its index, so the union is at most limit rows per part
+    if len(queries) > 1:
+        rows = db.execute(union_all(*[query.subquery().select() for query in queries])).all()
+    else:
+        rows = db.execute(timeline_keys).all()
+
+    keys = sorted({tuple(row) for row in rows}, reverse=True)[:limit]
+    return page(posts_with_votes(db, keys), keys, limit)
+
+# ----------------------------------------------------------------------------------------------------
+
+# WRITES
+
+
+def fan_out_post(db: Session, author, post_id: int, created_at: datetime):
+    """Copy a new post into the timeline of each of the author's followers. Runs in the caller's transaction."""
+
+    if author.fanout_on_read:
+        return
+    followers = select(models.Follow.follower_id, literal(post_id), literal(created_at, TIMESTAMP(timezone=True)),
+                       literal(author.id)).where(models.Follow.followee_id == author.id)
+    db.execute(insert(models.Timeline).from_select(
+        ["user_id", "post_id", "post_created_at", "author_id"], followers))
+
+
+def follow(db: Session, follower_id: int, followee_id: int):
+    """Returns True if the followee has just become (or already was) a fanout_on_read user."""
+
+    db.add(models.Follow(follower_id=follower_id, followee_id=followee_id))
+    db.flush()
+
+    # Counted in the database so two people following at once can't lose an update
+    fanout_on_read = db.execute(update(models.User).where(models.User.id == followee_id).values(
+        follower_count=models.User.follower_count + 1,
+        fanout_on_read=models.User.fanout_on_read | (models.User.follower_count + 1 >= settings.fanout_on_read_threshold)
+    ).returning(models.User.fanout_on_read).execution_options(synchronize_session=False)).scalar()
+
+    # Put their latest posts into our timeline, so our home feed isn't empty until they post again
+    if not fanout_on_read:
+        latest = author_post_keys(followee_id, settings.follow_backfill_posts).subquery()
+        db.execute(pg_insert(models.Timeline).from_select(
+            ["user_id", "post_id", "post_created_at", "author_id"],
+            select(literal(follower_id), latest.c.id, latest.c.created_at, literal(followee_id))
+        ).on_conflict_do_nothing())
+
+    return fanout_on_read
+
+
+def unfollow(db: Session, follower_id: int, followee_id: int):
+    db.execute(delete(models.Follow).where(models.Follow.follower_id == follower_id,
+                                           models.Follow.followee_id == followee_id)
+               .execution_options(synchronize_session=False))
+    db.execute(update(models.User).where(models.User.id == followee_id)
+               .values(follower_count=models.User.follower_count - 1)
+               .execution_options(synchronize_session=False))
+    db.execute(delete(models.Timeline).where(models.Timeline.user_id == follower_id,
+                                             models.Timeline.author_id == followee_id)
+               .execution_options(synchronize_session=False))
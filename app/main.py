@@ -1,8 +1,16 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from . import models
-from .database import engine
-from .routers import posts, users, auth, vote
+from .compression import CompressionMiddleware
+from .config import settings
+from .database import engine, RequestScopeMiddleware
+from .partitions import partition_maintainer
+from .profiling import ProfilingMiddleware
+from . import profiling
+from .pubsub import vote_broker
+from .purge import post_purger
+from .routers import posts, users, auth, vote, follow, feed
 
 # NOTES:
 # - the command to run the API commands is 'uvicorn [file name]:[app name] --reload
@@ -31,7 +39,19 @@ from .routers import posts, users, auth, vote
 # first started up. But since we have Alembic now, we don't need it anymore. We can un-comment it and it
 # won't break anything, but no real use for it. If we didn't use alembic, we would still need this^.
 
-app = FastAPI()
+# Everything before the yield runs once when the server starts, everything after it when the server shuts
+# down. This is where background workers get started and stopped.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    post_purger.start() # removes deleted posts in the background, look in purge.py
+    partition_maintainer.start() # creates next months' posts partitions, look in partitions.py
+    vote_broker.start() # sends live vote counts to /posts/stream, look in pubsub.py
+    yield
+    await vote_broker.stop()
+    partition_maintainer.stop()
+    post_purger.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 
@@ -44,6 +64,30 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# Compresses JSON responses with brotli or gzip, whichever the client accepts. Look in compression.py
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=settings.compression_minimum_size,
+    gzip_level=settings.compression_level,
+    brotli_quality=settings.compression_brotli_quality,
+    cache_size=settings.compression_cache_size,
+    cache_max_body_size=settings.compression_cache_max_body_size,
+    uncached_prefixes=(feed.router.prefix,) # every user's home feed is different, caching it never pays off
+)
+
+# Lets the slow query log (in database.py) say which route ran a slow query
+app.add_middleware(RequestScopeMiddleware)
+
+# Profiles some requests with a sampling profiler, look in profiling.py. When it's turned off we don't even
+# add the middleware, so it costs nothing.
+if settings.profile_sample_rate > 0 or settings.profile_debug_header:
+    app.add_middleware(
+        ProfilingMiddleware,
+        sample_rate=settings.profile_sample_rate,
+        debug_header=settings.profile_debug_header
+    )
+    app.include_router(profiling.router)
+
 # ----------------------------------------------------------------------------------------------------
 
 # Use Routers to keep main.py file uncluttered. Separate the posts and users routes/functions into
@@ -52,6 +96,8 @@ app.include_router(posts.router)
 app.include_router(users.router)
 app.include_router(auth.router)
 app.include_router(vote.router)
+app.include_router(follow.router)
+app.include_router(feed.router)
 
 # DONT NEED THIS
 @app.get("/")
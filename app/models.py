@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, ForeignKeyConstraint, Index, Sequence
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from sqlalchemy.sql.expression import text
@@ -7,29 +7,85 @@ from .database import Base
 class Post(Base):
     __tablename__ = "posts"
 
-    id = Column(Integer, primary_key=True, nullable=False) # nullable means cannot be a null value
+    # nullable means cannot be a null value. The sequence has to be named, because with a two column primary
+    # key (see created_at) SQLAlchemy no longer makes id a SERIAL column by itself
+    id = Column(Integer, Sequence("posts_id_seq"), primary_key=True, nullable=False)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False) # Has to be
     # same data type as foreign key, i.e. id column from users table. Cascade means if you delete a user,
     # all their posts will be deleted from the posts table. 
     title = Column(String, nullable=False)
     content = Column(String, nullable=False)
     published = Column(Boolean, server_default='True', nullable=False)
-    created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    # posts is partitioned by month of created_at (see the 'partition posts' migration and partitions.py),
+    # and Postgres requires the partition key to be part of the primary key, hence (id, created_at)
+    created_at = Column(TIMESTAMP(timezone=True), primary_key=True, nullable=False, server_default=text('now()'))
+    # Set when the owner deletes the post. From then on the post is hidden from every read, and the purge
+    # worker (purge.py) removes its votes and then the row itself in the background.
+    deleted_at = Column(TIMESTAMP(timezone=True), nullable=True)
+    # Goes up by one on every write. Sent to clients as the ETag, and checked against If-Match on writes.
+    version = Column(Integer, nullable=False, server_default='1')
 
     # In social media, we want to see someone's instagram handle, not their user id. So we set up a relationship,
     # when we retrive a post, it will have a property 'owner' that will figure out the relationship. We
     # Update the schema to return a Pydantic class that holds the user id. Look in schemas.py
     user = relationship("User")
 
+    __table_args__ = (
+        Index("ix_posts_created_at", created_at.desc(), id.desc()),
+        Index("ix_posts_user_id_created_at", user_id, created_at.desc(), id.desc()), # author timelines
+        Index("ix_posts_pending_delete", deleted_at, postgresql_where=deleted_at.isnot(None)),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, nullable=False)
     email = Column(String, nullable=False, unique=True)
     password = Column(String, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    follower_count = Column(Integer, nullable=False, server_default='0')
+    # Set for good once follower_count reaches settings.fanout_on_read_threshold. New posts from these users
+    # are NOT copied into every follower's timeline, followers' home feeds read them from posts instead.
+    fanout_on_read = Column(Boolean, nullable=False, server_default='False')
+
+    __table_args__ = (Index("ix_users_fanout_on_read", id, postgresql_where=fanout_on_read),)
 
 class Vote(Base):
     __tablename__ = "votes"
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
-    post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key = True)
+    post_id = Column(Integer, primary_key = True)
+    # A foreign key to the partitioned posts table has to include the partition key, so every vote also
+    # stores the created_at of the post it is for
+    post_created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+    # The primary key starts with user_id, so looking up all votes on a post needs its own index
+    __table_args__ = (
+        ForeignKeyConstraint(["post_id", "post_created_at"], ["posts.id", "posts.created_at"],
+                             name="votes_post_fk", ondelete="CASCADE"),
+        Index("ix_votes_post_id", "post_id"),
+    )
+
+class Follow(Base):
+    __tablename__ = "follows"
+    follower_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    followee_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+
+    # The primary key finds who a user follows, this one finds a user's followers (for fan-out)
+    __table_args__ = (Index("ix_follows_followee_id", "followee_id", "follower_id"),)
+
+class Timeline(Base):
+    # One row per (user, post that should show up in their home feed). Written when a post is created, for
+    # every follower of its author ('fan-out on write'). The primary key is in feed order, so reading a page
+    # of someone's home feed is one index range scan.
+    __tablename__ = "timelines"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    post_created_at = Column(TIMESTAMP(timezone=True), primary_key=True)
+    post_id = Column(Integer, primary_key=True)
+    author_id = Column(Integer, nullable=False)
 
+    __table_args__ = (
+        ForeignKeyConstraint(["post_id", "post_created_at"], ["posts.id", "posts.created_at"],
+                             name="timelines_post_fk", ondelete="CASCADE"),
+        Index("ix_timelines_post", "post_id", "post_created_at"),
+    )
@@ -5,6 +5,7 @@ from fastapi import Depends, status, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from .config import settings
+from .profiling import attach_thread
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='login')
 
@@ -48,8 +49,10 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
                                           detail=f'Could not validate credentials',
                                           headers={'WWW-Authenticate':'Bearer'})
     
-    token = verify_access_token(token, credentials_exception)
-    user = db.query(models.User).filter(models.User.id == token.id).first()
+    # Dependencies run on their own threadpool thread, so attach it to the profiler too (look in profiling.py)
+    with attach_thread():
+        token = verify_access_token(token, credentials_exception)
+        user = db.query(models.User).filter(models.User.id == token.id).first()
 
     return user
     
\ No newline at end of file
@@ -0,0 +1,130 @@
+"""Maintenance of the monthly partitions of the posts table.
+
+    python -m app.partitions ensure             # create any missing partitions up to N months ahead
+    python -m app.partitions list
+    python -m app.partitions detach 2024_08     # detach posts_2024_08 so it can be archived
+
+"""
+import argparse
+import logging
+import re
+import threading
+from sqlalchemy import text
+from .config import settings
+from .database import engine
+
+logger = logging.getLogger(__name__)
+
+# NOTES:
+# - posts is partitioned by month of created_at (look at the 'partition posts' migration). Every insert
+#   needs a partition for its month to already exist, so we keep a few months ahead created. The app does
+#   that on startup and then once a day, in a background thread.
+# - Detaching a partition takes its posts out of the posts table (the posts_YYYY_MM table stays, so you can
+#   dump it or move it somewhere cheaper). Votes point at posts with a foreign key, so votes on those posts
+#   are moved into votes_archive first, in the same transaction. Timelines rows point at posts too, they
+#   are just deleted: nobody's home feed goes back that far anyway.
+
+
+def ensure_future_partitions(months_ahead: int = settings.posts_partition_months_ahead):
+    """Create the monthly partitions from this month up to months_ahead months from now. Returns how many
+    partitions were created."""
+
+    with engine.begin() as conn:
+        return conn.execute(text("SELECT create_posts_partitions(now(), :months_ahead)"),
+                            {"months_ahead": months_ahead}).scalar()
+
+
+def list_partitions():
+    with engine.connect() as conn:
+        return conn.execute(text("""
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = 'posts'
+            ORDER BY child.relname
+        """)).all()
+
+
+def detach_partition(month: str):
+    """Detach posts_<month> (month written as YYYY_MM) from the posts table. Returns the number of votes
+    that were moved to votes_archive."""
+
+    if not re.fullmatch(r'\d{4}_\d{2}', month):
+        raise ValueError(f'month should look like 2024_08, not {month!r}')
+
+    partition = f'posts_{month}'
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT to_regclass(:name)"), {"name": partition}).scalar() is None:
+            raise ValueError(f'partition {partition} does not exist')
+
+        # Using the partition's own table in the subquery means we only look at posts from that month
+        moved = conn.execute(text(f"""
+            WITH moved AS (
+                DELETE FROM votes WHERE (post_id, post_created_at) IN (SELECT id, created_at FROM {partition})
+                RETURNING user_id, post_id, post_created_at
+            )
+            INSERT INTO votes_archive (user_id, post_id, post_created_at) SELECT * FROM moved
+        """)).rowcount
+        conn.execute(text(f"""
+            DELETE FROM timelines WHERE (post_id, post_created_at) IN (SELECT id, created_at FROM {partition})
+        """))
+        conn.execute(text(f"ALTER TABLE posts DETACH PARTITION {partition}"))
+
+    logger.info('detached %s, moved %s votes to votes_archive', partition, moved)
+    return moved
+
+
+class PartitionMaintainer:
+    """Background thread that calls ensure_future_partitions() every interval (a day by default)."""
+
+    def __init__(self, interval: float = 24 * 60 * 60):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='partition-maintainer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                created = ensure_future_partitions()
+                if created:
+                    logger.info('created %s posts partitions', created)
+            except Exception:
+                logger.exception('creating posts partitions failed, will retry')
+            self._stop.wait(self.interval)
+
+
+partition_maintainer = PartitionMaintainer()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    ensure = commands.add_parser('ensure')
+    ensure.add_argument('--months-ahead', type=int, default=settings.posts_partition_months_ahead)
+    commands.add_parser('list')
+    detach = commands.add_parser('detach')
+    detach.add_argument('month', help='YYYY_MM, e.g. 2024_08')
+    args = parser.parse_args()
+
+    if args.command == 'ensure':
+        print(f'created {ensure_future_partitions(args.months_ahead)} partitions')
+    elif args.command == 'list':
+        for name, bounds in list_partitions():
+            print(f'{name}: {bounds}')
+    else:
+        print(f'detached posts_{args.month}, moved {detach_partition(args.month)} votes to votes_archive')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""Opt-in sampling profiler for requests.
+
+    python -m app.profiling sign            # prints an X-Debug-Profile header value, valid for 10 minutes
+    python -m app.profiling sign --ttl 60
+
+"""
+import argparse
+import hashlib
+import hmac
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from fastapi import APIRouter, Header, HTTPException, status
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+from .config import settings
+
+# NOTES:
+# - When p99 goes up we want to see where the Python time goes inside a request: building ORM objects,
+#   pydantic, decoding the JWT, bcrypt. This samples the stack of the threads working on a profiled request
+#   every few milliseconds and adds the stacks up per route, in the 'folded' format flame graph tools read
+#   (flamegraph.pl, speedscope.app).
+# - Which requests get profiled: a random settings.profile_sample_rate fraction of them, plus any request
+#   with a valid signed X-Debug-Profile header when settings.profile_debug_header is on. The header is
+#   '<expiry unix time>.<HMAC of it with the secret key>', make one with 'python -m app.profiling sign'.
+# - A request's work is spread over threads: the event loop thread, plus the threadpool threads that run
+#   our sync endpoints and dependencies. Each of those registers itself while it works on a profiled
+#   request (see attach_thread, used by the middleware, AppRoute in routing.py and get_current_user).
+#   The event loop thread is shared by all requests, so its samples count for every profiled request that
+#   is in flight at that moment.
+# - It costs nothing when it's off: main.py only adds the middleware and the /internal/profiles routes if
+#   profiling is turned on, and the sampler thread only starts for the first profiled request.
+
+DEBUG_HEADER = 'x-debug-profile'
+MAX_STACK_DEPTH = 128
+MAX_STACKS_PER_ROUTE = 5000
+
+# Modules that are at the top of the event loop thread's stack when the loop is waiting for something to do.
+# The stock asyncio loop waits in selectors. uvloop (which uvicorn uses when it's installed) waits in C, so
+# there the innermost Python frame is whatever started the loop: asyncio.runners, or uvloop.run.
+IDLE_LOOP_MODULES = {'selectors', 'asyncio.runners', 'asyncio.base_events', 'uvloop'}
+
+current_profile = ContextVar('current_profile', default=None)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.stacks = Counter()
+
+
+def fold_stack(frame):
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler:
+    """One background thread that samples every registered thread's stack each interval."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._threads = defaultdict(Counter) # thread ident -> {RequestProfile: times attached}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def attach(self, ident: int, profile: RequestProfile):
+        with self._condition:
+            self._threads[ident][profile] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def detach(self, ident: int, profile: RequestProfile):
+        with self._condition:
+            profiles = self._threads[ident]
+            profiles[profile] -= 1
+            if profiles[profile] <= 0:
+                del profiles[profile]
+            if not profiles:
+                del self._threads[ident]
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while True:
+            with self._condition:
+                while not self._threads:
+                    self._condition.wait() # sleeps until a profiled request comes in
+                threads = {ident: list(profiles) for ident, profiles in self._threads.items()}
+
+            frames = sys._current_frames()
+            for ident, profiles in threads.items():
+                frame = frames.get(ident)
+                # An idle event loop is waiting, not working, leave it out of the picture. Without this, every
+                # sample taken while a sync endpoint runs in the threadpool would count the loop as busy too.
+                if frame is None or ident == own_ident or frame.f_globals.get('__name__') in IDLE_LOOP_MODULES:
+                    continue
+                stack = fold_stack(frame)
+                for profile in profiles:
+                    profile.stacks[stack] += 1
+            del frames
+
+            time.sleep(self.interval)
+
+
+sampler = Sampler(interval=settings.profile_interval_ms / 1000)
+
+
+_not_profiled = nullcontext()
+
+
+def attach_thread():
+    """Sample the current thread for as long as this block runs, if the current request is being profiled.
+    When it isn't, this is a ContextVar lookup that returns one shared do-nothing context manager."""
+
+    profile = current_profile.get()
+    if profile is None:
+        return _not_profiled
+    return _attached(profile)
+
+
+@contextmanager
+def _attached(profile: RequestProfile):
+    ident = threading.get_ident()
+    sampler.attach(ident, profile)
+    try:
+        yield
+    finally:
+        sampler.detach(ident, profile)
+
+
+class RouteProfiles:
+    """Samples from finished requests, added up per route."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stacks = defaultdict(Counter)
+        self._requests = Counter()
+
+    def add(self, route: str, profile: RequestProfile):
+        with self._lock:
+            self._requests[route] += 1
+            stacks = self._stacks[route]
+            for stack, samples in profile.stacks.items():
+                if stack in stacks or len(stacks) < MAX_STACKS_PER_ROUTE:
+                    stacks[stack] += samples
+                else:
+                    stacks['[other stacks]'] += samples
+
+    def summary(self):
+        with self._lock:
+            return {route: {'requests': self._requests[route], 'samples': sum(self._stacks[route].values())}
+                    for route in self._requests}
+
+    def folded(self, route: str):
+        with self._lock:
+            return '\n'.join(f'{stack} {samples}' for stack, samples in self._stacks.get(route, {}).items())
+
+    def clear(self):
+        with self._lock:
+            self._stacks.clear()
+            self._requests.clear()
+
+
+route_profiles = RouteProfiles()
+
+
+def sign_debug_header(ttl_seconds: int = 600):
+    expires = str(int(time.time()) + ttl_seconds)
+    signature = hmac.new(settings.secret_key.encode(), expires.encode(), hashlib.sha256).hexdigest()
+    return f'{expires}.{signature}'
+
+
+def valid_debug_header(value: Optional[str]):
+    if not value:
+        return False
+    expires, _, signature = value.partition('.')
+    expected = hmac.new(settings.secret_key.encode(), expires.encode('latin-1'), hashlib.sha256).hexdigest()
+    # Compared as bytes: compare_digest raises TypeError on str with non-ASCII characters in it, and header
+    # values are decoded as latin-1, so a client could otherwise turn a bad header into a 500
+    return (hmac.compare_digest(signature.encode('latin-1'), expected.encode())
+            and expires.isdigit() and int(expires) >= time.time())
+
+
+class ProfilingMiddleware:
+
+    def __init__(self, app, sample_rate: float = 0.0, debug_header: bool = False):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.debug_header = debug_header
+
+    def wants_profile(self, scope):
+        if scope['path'].startswith(router.prefix):
+            return False
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return True
+        if self.debug_header:
+            for name, value in scope['headers']:
+                if name == DEBUG_HEADER.encode():
+                    return valid_debug_header(value.decode('latin-1'))
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        try:
+            with attach_thread(): # the event loop thread, for middleware, async code and JSON encoding
+                await self.app(scope, receive, send)
+        finally:
+            current_profile.reset(token)
+            route = scope.get('route')
+            route_profiles.add(f"{scope['method']} {route.path if route is not None else scope['path']}", profile)
+
+
+# ----------------------------------------------------------------------------------------------------
+
+# INTERNAL ENDPOINTS TO READ THE PROFILES
+# GET {{URL}}internal/profiles -> requests and samples per route
+# GET {{URL}}internal/profiles/folded?route=GET /posts/ -> folded stacks, save it and open in speedscope.app
+# DELETE {{URL}}internal/profiles -> start over
+# All of them need a valid X-Debug-Profile header, same as the one that turns profiling on for a request.
+
+router = APIRouter(
+    prefix="/internal/profiles",
+    tags=["Internal"],
+    include_in_schema=False
+)
+
+
+def check_debug_header(x_debug_profile: Optional[str]):
+    if not valid_debug_header(x_debug_profile):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Not Found')
+
+
+@router.get("/")
+def get_profiles(x_debug_profile: Optional[str] = Header(None)):
+    check_debug_header(x_debug_profile)
+    return route_profiles.summary()
+
+
+@router.get("/folded", response_class=PlainTextResponse)
+def get_folded_profile(route: str, x_debug_profile: Optional[str] = Header(None)):
+    check_debug_header(x_debug_profile)
+    return route_profiles.folded(route)
+
+
+@router.delete("/", status_code=status.HTTP_204_NO_CONTENT)
+def clear_profiles(x_debug_profile: Optional[str] = Header(None)):
+    check_debug_header(x_debug_profile)
+    route_profiles.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    sign = commands.add_parser('sign')
+    sign.add_argument('--ttl', type=int, default=600, help='seconds until the header stops working')
+    args = parser.parse_args()
+
+    print(f'X-Debug-Profile: {sign_debug_header(args.ttl)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from sqlalchemy import func, select
+from starlette.concurrency import run_in_threadpool
+from . import models
+from .config import settings
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# LIVE VOTE COUNTS
+# - Clients used to poll GET /posts/{id} to keep like counts fresh. Now they can open the /posts/stream
+#   websocket, say which posts they're looking at, and get sent the new count whenever it changes.
+# - The vote router calls publish(post_id) after every vote. That only marks the post as changed. Every
+#   interval, the broker looks up the counts of all changed posts that somebody is watching in ONE query
+#   and sends them out. So a burst of 1000 votes on a post costs one count and one message per watcher.
+# - Each subscriber has a dict of post_id -> count waiting to be sent. A newer count replaces an older one
+#   that hasn't gone out yet, so a slow client only ever gets the latest counts and never builds a backlog.
+# - This is in-process: a vote is only pushed to clients connected to the same uvicorn process. Procfile
+#   runs a single process. If you add --workers, votes need to go through something shared like Postgres
+#   LISTEN/NOTIFY or Redis instead.
+
+
+class Subscription:
+    """One connected client. Everything here runs on the event loop, so no locking is needed."""
+
+    def __init__(self):
+        self.post_ids = set()
+        self._pending = {}
+        self._ready = asyncio.Event()
+
+    def offer(self, post_id: int, votes: int):
+        self._pending[post_id] = votes
+        self._ready.set()
+
+    async def next_updates(self):
+        await self._ready.wait()
+        self._ready.clear()
+        updates, self._pending = self._pending, {}
+        return updates
+
+
+def count_votes(post_ids):
+    db = SessionLocal()
+    try:
+        rows = db.execute(select(models.Vote.post_id, func.count(models.Vote.post_id))
+                          .where(models.Vote.post_id.in_(post_ids)).group_by(models.Vote.post_id)).all()
+        return dict(rows)
+    finally:
+        db.close()
+
+
+class VoteBroker:
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._subscribers = defaultdict(set) # post_id -> set of Subscription
+        self._changed = set()
+        self._changed_lock = threading.Lock() # publish() is called from the threadpool the sync routes run in
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._flush_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def publish(self, post_id: int):
+        """Mark the vote count of a post as changed. Safe to call from any thread."""
+        with self._changed_lock:
+            self._changed.add(post_id)
+
+    def subscribe(self, subscription: Subscription, post_ids):
+        for post_id in post_ids:
+            subscription.post_ids.add(post_id)
+            self._subscribers[post_id].add(subscription)
+            self.publish(post_id) # so the new subscriber gets the current count on the next flush
+
+    def unsubscribe(self, subscription: Subscription, post_ids):
+        for post_id in post_ids:
+            subscription.post_ids.discard(post_id)
+            watchers = self._subscribers.get(post_id)
+            if watchers is not None:
+                watchers.discard(subscription)
+                if not watchers:
+                    del self._subscribers[post_id]
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('sending vote counts failed')
+
+    async def flush(self):
+        with self._changed_lock:
+            changed, self._changed = self._changed, set()
+
+        watched = [post_id for post_id in changed if post_id in self._subscribers]
+        if not watched:
+            return
+
+        counts = await run_in_threadpool(count_votes, watched)
+        for post_id in watched:
+            for subscription in self._subscribers.get(post_id, ()):
+                subscription.offer(post_id, counts.get(post_id, 0))
+
+
+vote_broker = VoteBroker(interval=settings.stream_interval_seconds)
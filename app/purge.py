@@ -0,0 +1,98 @@
+import logging
+import threading
+from sqlalchemy import delete, select
+from . import models
+from .config import settings
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# BACKGROUND DELETION OF POSTS
+# - Deleting a post used to delete the row straight away, and ON DELETE CASCADE then deleted every vote on
+#   it in the same transaction. For a popular post that's a lot of rows locked while the client waits.
+# - Now delete_post only sets posts.deleted_at and returns. Every read filters those posts out, so to users
+#   the post is gone immediately.
+# - This worker finds posts with deleted_at set, deletes their votes and timelines rows (one per follower
+#   of the author) a chunk at a time (each chunk is its own short transaction), then deletes the post row,
+#   which by then has nothing left to cascade.
+# - There is no separate job queue: the posts table itself is the queue. If the process dies half way,
+#   the chunks that were committed stay deleted, and the next run carries on with whatever is left.
+# - Each step is idempotent, so it doesn't matter if more than one uvicorn worker runs it at once.
+
+
+class PostPurger:
+
+    def __init__(self, chunk_size: int, interval: float):
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='post-purger', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wake(self):
+        """Start purging now rather than at the next interval. Called by delete_post."""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.purge_pending()
+            except Exception:
+                logger.exception('purging deleted posts failed, will retry')
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def purge_pending(self):
+        db = SessionLocal()
+        try:
+            while not self._stop.is_set():
+                post_ids = db.execute(select(models.Post.id).where(models.Post.deleted_at.isnot(None))
+                                      .order_by(models.Post.deleted_at).limit(100)).scalars().all()
+                db.commit()
+                if not post_ids:
+                    return
+                for post_id in post_ids:
+                    self.purge_post(db, post_id)
+                    if self._stop.is_set():
+                        return
+        finally:
+            db.close()
+
+    def delete_in_chunks(self, db, table, post_id: int):
+        removed = 0
+        while not self._stop.is_set():
+            chunk = select(table.user_id).where(table.post_id == post_id).limit(self.chunk_size)
+            result = db.execute(delete(table).where(table.post_id == post_id, table.user_id.in_(chunk))
+                                .execution_options(synchronize_session=False))
+            db.commit()
+            removed += result.rowcount
+            if result.rowcount < self.chunk_size:
+                break
+            logger.info('purging post %s: %s %s rows removed so far', post_id, removed, table.__tablename__)
+        return removed
+
+    def purge_post(self, db, post_id: int):
+        removed = self.delete_in_chunks(db, models.Vote, post_id)
+        self.delete_in_chunks(db, models.Timeline, post_id)
+
+        if self._stop.is_set():
+            return
+
+        db.execute(delete(models.Post).where(models.Post.id == post_id, models.Post.deleted_at.isnot(None))
+                   .execution_options(synchronize_session=False))
+        db.commit()
+        logger.info('purged post %s (%s votes)', post_id, removed)
+
+
+post_purger = PostPurger(chunk_size=settings.purge_chunk_size, interval=settings.purge_interval_seconds)
@@ -2,10 +2,12 @@ from fastapi import APIRouter, Depends, status, HTTPException, Response
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 from .. import database, schemas, models, utils, oauth2
+from ..routing import AppRoute
 
 
 router = APIRouter(
-    tags=['Authentication']
+    tags=['Authentication'],
+    route_class=AppRoute
 )
 
 @router.post('/login', response_model=schemas.Token)
@@ -20,9 +22,17 @@ def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session =
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail='Invalid Credentials')
     
-    if not utils.verify(user_credentials.password, user.password):
+    verified, new_hash = utils.verify_and_update(user_credentials.password, user.password)
+
+    if not verified:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail='Invalid Credentials')
+
+    # The stored hash was made with a different bcrypt cost than settings.bcrypt_rounds. We have the plain
+    # password right now, so store a hash at the configured cost. This is how a cost change rolls out.
+    if new_hash:
+        user.password = new_hash
+        db.commit()
     
     # create token
     # return token
@@ -0,0 +1,23 @@
+from fastapi import Depends, APIRouter, Query
+from sqlalchemy.orm import Session
+from typing import Optional
+from .. import oauth2, feeds
+from ..config import settings
+from ..database import get_db
+from ..routing import AppRoute
+
+# HOME FEED: {{URL}}feed?limit=20 -> latest posts from everyone you follow, newest first.
+# NEXT PAGE: {{URL}}feed?limit=20&cursor=<next_cursor from the previous page>. next_cursor is null on the
+#   last page. Look in feeds.py for how it's built.
+
+router = APIRouter(
+    prefix="/feed",
+    tags=["Feed"],
+    route_class=AppRoute
+)
+
+@router.get("/")
+def get_feed(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user),
+             limit: int = Query(20, gt=0, le=settings.feed_max_limit), cursor: Optional[str] = None):
+
+    return feeds.home_feed(db, current_user.id, limit, cursor)
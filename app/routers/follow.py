@@ -0,0 +1,51 @@
+from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter
+from sqlalchemy.orm import Session
+from .. import schemas, database, models, oauth2, feeds
+from ..routing import AppRoute
+
+# FOLLOW AND UNFOLLOW: POST {{URL}}follow with {"user_id": 3, "dir": 1} to follow, "dir": 0 to unfollow.
+# Following someone copies their latest posts into your timeline, unfollowing takes them out again, so
+# your home feed (GET {{URL}}feed) changes straight away. Look in feeds.py for how the timelines work.
+
+router = APIRouter(
+    prefix='/follow',
+    tags=['Follow'],
+    route_class=AppRoute
+)
+
+@router.post("/", status_code=status.HTTP_201_CREATED)
+def follow(follow: schemas.Follow, db: Session = Depends(database.get_db), current_user: int = Depends(
+                                                                         oauth2.get_current_user)):
+
+    if follow.user_id == current_user.id:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='You cannot follow yourself')
+
+    # Check that the user being followed exists in the first place
+    if not db.query(models.User.id).filter(models.User.id == follow.user_id).first():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'User with id: {follow.user_id} does not exist')
+
+    found_follow = db.query(models.Follow).filter(models.Follow.follower_id == current_user.id,
+                                                  models.Follow.followee_id == follow.user_id).first()
+
+    # If the user is being followed
+    if follow.dir == 1:
+
+        if found_follow:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail=f'user {current_user.id} already follows user {follow.user_id}')
+        fanout_on_read = feeds.follow(db, current_user.id, follow.user_id)
+        db.commit()
+        if fanout_on_read:
+            feeds.fanout_on_read_users.bump() # so home feeds start reading their posts without waiting
+        return {'message': 'successfully followed user'}
+
+    # If the user is being unfollowed
+    else:
+        if not found_follow:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Follow does not exist')
+
+        feeds.unfollow(db, current_user.id, follow.user_id)
+        db.commit()
+
+        return {'message': 'successfully unfollowed user'}
@@ -1,8 +1,17 @@
-from .. import models, schemas, oauth2
+from .. import models, schemas, oauth2, feeds
+from ..cache import posts_cache
+from ..config import settings
 from ..database import engine, get_db
-from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter
+from ..pubsub import Subscription, vote_broker
+from ..purge import post_purger
+from ..routing import AppRoute
+from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter, Header, Query
+from fastapi import WebSocket
+from fastapi.encoders import jsonable_encoder
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, insert, update
+from datetime import datetime, timedelta, timezone
+import asyncio
 from typing import List, Optional
 
 # --------QUERY PARAMETERS--------
@@ -10,11 +19,14 @@ from typing import List, Optional
 # SKIP POSTS: {{URL}}posts?limit=3&skip=2 
 # SEARCH BASED OFF TITLE: {{URL}}posts?limit=3&skip=2&search=ak -> don't enter string in quotation marks
 # SPACEBAR IN SEARCH PARAMETER: %20, e.g. search=beautiful%20beaches
+# ONLY RECENT POSTS: {{URL}}posts?max_age_days=7 -> defaults to settings.feed_max_age_days. posts is partitioned
+#   by month of created_at, and this bound lets Postgres skip every partition older than that.
 
 # Initialise the router, and how the decorators used to be app.get, change to router.get, or router.post, etc.
 router = APIRouter(
     prefix="/posts", # So that we don't have to keep typing in the annoying /posts in the routes
-    tags=["Posts"]
+    tags=["Posts"],
+    route_class=AppRoute # ends the db transaction as soon as the endpoint returns, look in routing.py
 )
 
 # ----------------------------------------------------------------------------------------------------
@@ -23,105 +35,266 @@ router = APIRouter(
 
 @router.get("/") # We return posts, which is a list of posts, so import List from typing to coerce to correct data type
 def get_posts(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user),
-              limit: int = 10, skip: int = 0, search: Optional[str] = ""):
+              limit: int = 10, skip: int = 0, search: Optional[str] = "",
+              max_age_days: int = Query(settings.feed_max_age_days, gt=0)):
+
+    def run_query():
+        # Worked out here rather than as now() - interval in SQL, so it's a plain value when the query is
+        # planned and the old partitions get pruned from the plan itself
+        since = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+
+        # group_by has to name the whole primary key (id, created_at) for Postgres to let us select the other
+        # posts columns without grouping by them too
+        results = db.query(models.Post, func.count(models.Vote.post_id).label("votes"))\
+            .join(models.Vote, models.Vote.post_id == models.Post.id, isouter=True)\
+            .group_by(models.Post.id, models.Post.created_at)\
+            .filter(models.Post.created_at >= since, models.Post.title.contains(search),
+                    models.Post.deleted_at.is_(None))\
+            .limit(limit).offset(skip).all()
+
+        # .filter(models.Post.title.contains(search)).limit(limit).offset(skip).all()
+
+        # Turned into plain dicts and lists now, so a cached page doesn't hold on to ORM objects
+        return jsonable_encoder(results)
+
+    # The first pages are requested over and over with the same parameters, so they come from posts_cache
+    # (look in cache.py) until the next write. Deeper pages always run the query, and so do huge ones, so
+    # that ?limit=1000000 can't fill the cache with enormous pages.
+    if skip >= settings.posts_cache_max_skip or limit > settings.posts_cache_max_limit:
+        return run_query()
+
+    # db.commit ends our transaction (get_current_user already used it) before waiting on another request
+    return posts_cache.get_or_compute(("posts", limit, skip, search or "", max_age_days), run_query,
+                                      before_wait=db.commit)
 
-    results = db.query(models.Post, func.count(models.Vote.post_id).label("votes"))\
-        .join(models.Vote, models.Vote.post_id == models.Post.id, isouter=True)\
-        .group_by(models.Post.id).filter(models.Post.title.contains(search))\
-        .limit(limit).offset(skip).all()
-    
-    # .filter(models.Post.title.contains(search)).limit(limit).offset(skip).all()
+# ----------------------------------------------------------------------------------------------------
 
-    return results
+# LIVE VOTE COUNTS OVER A WEBSOCKET
+# - Connect to ws://{{URL}}posts/stream?token=<access token>. Browsers can't set an Authorization header on
+#   a websocket, so the token goes in the URL. We only check the token's signature, we don't hold a database
+#   session for as long as the socket is open.
+# - Send {"subscribe": [1, 2, 3]} or {"unsubscribe": [2]}. You get {"votes": {"1": 12, "3": 4}} with the
+#   current counts straight away, and again whenever they change (at most once per post per interval).
+# - This is an async function on purpose: an idle connection is just a coroutine waiting on the event loop,
+#   not a thread, so one process can hold tens of thousands of them. Look in pubsub.py for the rest.
+# - Websocket routes don't clash with the GET /{id} route below, but it's up here to keep the note about
+#   route ORDER in main.py in mind.
+
+@router.websocket("/stream")
+async def stream_votes(websocket: WebSocket, token: str = ""):
+
+    try:
+        oauth2.verify_access_token(token, ValueError('Could not validate credentials'))
+    except ValueError:
+        await websocket.close(code=1008) # policy violation
+        return
+
+    await websocket.accept()
+    subscription = Subscription()
+
+    async def receive_subscriptions():
+        while True:
+            try:
+                message = await websocket.receive_json()
+                subscribe = {int(id) for id in message.get('subscribe', [])}
+                unsubscribe = {int(id) for id in message.get('unsubscribe', [])}
+            except (AttributeError, TypeError, ValueError):
+                await websocket.send_json({'error': 'expected {"subscribe": [ids]} or {"unsubscribe": [ids]}'})
+                continue
+
+            vote_broker.unsubscribe(subscription, unsubscribe)
+            room = settings.stream_max_posts_per_client - len(subscription.post_ids)
+            new_ids = sorted(subscribe - subscription.post_ids)
+            if len(new_ids) > room:
+                await websocket.send_json({'error': f'can watch at most {settings.stream_max_posts_per_client} posts'})
+                new_ids = new_ids[:max(room, 0)]
+            vote_broker.subscribe(subscription, new_ids)
+
+    async def send_updates():
+        while True:
+            updates = await subscription.next_updates()
+            await websocket.send_json({'votes': updates})
+
+    # Whichever side stops first (usually the client disconnecting) ends the connection
+    tasks = [asyncio.create_task(receive_subscriptions()), asyncio.create_task(send_updates())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        vote_broker.unsubscribe(subscription, list(subscription.post_ids))
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 # ----------------------------------------------------------------------------------------------------
 
 # GET SINGULAR POST USING SQLALCHEMY
 
 @router.get("/{id}")
-def get_post(id: int, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+def get_post(id: int, response: Response, db: Session = Depends(get_db),
+             current_user: int = Depends(oauth2.get_current_user)):
 
     post = db.query(models.Post, func.count(models.Vote.post_id).label("votes")).join(
-        models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(models.Post.id).filter(
-            models.Post.id == id).first() # first() finds first instance of id match
+        models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(
+            models.Post.id, models.Post.created_at).filter(
+            models.Post.id == id, models.Post.deleted_at.is_(None)).first() # first() finds first instance of id match
 
     if not post:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'post with id: {id} was not found')
     
+    response.headers['ETag'] = post_etag(post.Post.version)
     return post
 
 # ----------------------------------------------------------------------------------------------------
 
+# WRITES WITH RETURNING
+# - Every write below is ONE statement: INSERT/UPDATE ... RETURNING gives us the row back in the same round
+#   trip (no db.refresh, no SELECT first to check the post exists). The ownership check goes in the WHERE
+#   clause, so a post that isn't ours simply doesn't match.
+# - Only when nothing matched do we run a second query, to work out WHICH error to return (404/403/412).
+# - The nested 'user' in the response is current_user, which get_current_user already loaded. We turn it
+#   into a UserOut straight away, so the response never needs to go back to the database for the author.
+# - OPTIMISTIC CONCURRENCY: every post has a version number, sent back in the ETag header. Send it back in
+#   an If-Match header on PUT/DELETE and the write only happens if nobody changed the post in between,
+#   otherwise you get 412 Precondition Failed. Leave If-Match out and the write always goes ahead.
+
+def post_etag(version: int):
+    return f'"{version}"'
+
+
+def parse_if_match(if_match: Optional[str]):
+    if if_match is None or if_match.strip() == '*':
+        return None
+    try:
+        return int(if_match.strip().removeprefix('W/').strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED,
+                            detail='If-Match must be an ETag returned by this API')
+
+
+def raise_write_failed(db: Session, id: int, current_user):
+    post = db.query(models.Post.user_id).filter(models.Post.id == id, models.Post.deleted_at.is_(None)).first()
+
+    if post == None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'post with id: {id} does not exist.')
+
+    if post.user_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail='You are not authorized to perform this action.')
+
+    raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED,
+                        detail=f'post with id: {id} has been changed since you last fetched it.')
+
+# ----------------------------------------------------------------------------------------------------
+
 # CREATE NEW POST USING SQLALCHEMY
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.Post)
-def create_posts(post: schemas.PostCreate, db: Session = Depends(get_db), current_user: int = Depends(
-                                                                          oauth2.get_current_user)):
-    # In the code commented out below, we have to list every field as title=post.title, etc...
-    # What if we had 50 columns, i.e. 50 fields? It would be very inefficient. Better way to do it is
-    # convert to a dictionary using Pydantic and then unpack it. Also, the user_id field comes from the
-    # Post(PostBase) schema from schemas.py! We have to provide a user_id for each post. However, it makes
-    # sense that the person currently logged in is the same person making the post, so we can set user_id
-    # to current_user.id!
-    new_post = models.Post(user_id=current_user.id, **post.model_dump())
-
-    # new_post = models.Post(title=post.title, content=post.content, published=post.published)
-
-    db.add(new_post) # add to database
+def create_posts(post: schemas.PostCreate, response: Response, db: Session = Depends(get_db),
+                 current_user: int = Depends(oauth2.get_current_user)):
+    # We convert the request to a dictionary using Pydantic and then unpack it, rather than listing every
+    # field as title=post.title, etc... Also, the user_id field comes from the Post(PostBase) schema from
+    # schemas.py! We have to provide a user_id for each post. However, it makes sense that the person
+    # currently logged in is the same person making the post, so we can set user_id to current_user.id!
+    new_post = db.execute(insert(models.Post).values(user_id=current_user.id, **post.model_dump())
+                          .returning(*models.Post.__table__.c)).mappings().one() # same as RETURNING *
+
+    # Copy it into every follower's home feed, in the same transaction (look in feeds.py)
+    feeds.fan_out_post(db, current_user, new_post['id'], new_post['created_at'])
+
+    author = schemas.UserOut.model_validate(current_user, from_attributes=True)
     db.commit() # commit the changes
-    db.refresh(new_post) # retrieve the new post and store back into variable new_post, same as RETURNING *
-    return new_post
+    posts_cache.bump()
+
+    response.headers['ETag'] = post_etag(new_post['version'])
+    return {**new_post, 'user': author}
 
 # ----------------------------------------------------------------------------------------------------
 
 # UPDATE POST USING SQLALCHEMY
 
 @router.put("/{id}", response_model=schemas.Post)
-def update_post(id: int, post: schemas.PostCreate, db: Session = Depends(get_db), current_user: int = Depends(
-                                                                                  oauth2.get_current_user)):
+def update_post(id: int, post: schemas.PostCreate, response: Response, db: Session = Depends(get_db),
+                current_user: int = Depends(oauth2.get_current_user), if_match: Optional[str] = Header(None)):
 
-    post_query = db.query(models.Post).filter(models.Post.id == id)
-    first_post = post_query.first()
+    expected_version = parse_if_match(if_match)
 
-    if first_post == None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'post with id: {id} does not exist.')
-    
-    if first_post.user_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                            detail='You are not authorized to perform this action.')
-    
-    post_query.update(post.model_dump(), synchronize_session=False)
+    update_query = update(models.Post).where(models.Post.id == id, models.Post.user_id == current_user.id,
+                                             models.Post.deleted_at.is_(None))
+    if expected_version is not None:
+        update_query = update_query.where(models.Post.version == expected_version)
+
+    updated_post = db.execute(update_query.values(version=models.Post.version + 1, **post.model_dump())
+                              .returning(*models.Post.__table__.c)
+                              .execution_options(synchronize_session=False)).mappings().first()
+
+    if updated_post == None:
+        raise_write_failed(db, id, current_user)
+
+    author = schemas.UserOut.model_validate(current_user, from_attributes=True)
     db.commit()
+    posts_cache.bump()
 
-    return first_post
+    response.headers['ETag'] = post_etag(updated_post['version'])
+    return {**updated_post, 'user': author}
 
 # ----------------------------------------------------------------------------------------------------
 
 # DELETE POST USING SQLALCHEMY
 
 @router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_post(id: int, db: Session = Depends(get_db), current_user: int = Depends(
-                                                        oauth2.get_current_user)):
+def delete_post(id: int, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user),
+                if_match: Optional[str] = Header(None)):
+
+    expected_version = parse_if_match(if_match)
 
-    post_query = db.query(models.Post).filter(models.Post.id == id)
+    # Soft delete: the post disappears from every read as soon as this commits, but the row and its votes
+    # are removed later, in small chunks, by the purge worker. Look in purge.py
+    delete_query = update(models.Post).where(models.Post.id == id, models.Post.user_id == current_user.id,
+                                             models.Post.deleted_at.is_(None))
+    if expected_version is not None:
+        delete_query = delete_query.where(models.Post.version == expected_version)
 
-    post = post_query.first()
+    deleted_post = db.execute(delete_query.values(deleted_at=func.now(), version=models.Post.version + 1)
+                              .returning(models.Post.id)
+                              .execution_options(synchronize_session=False)).first()
 
+    # If the post doesn't exist, or the current user is trying to delete a post made by someone else:
+    if deleted_post == None:
+        raise_write_failed(db, id, current_user)
+
+    db.commit()
+    posts_cache.bump()
+    post_purger.wake()
+
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+# ----------------------------------------------------------------------------------------------------
+
+# CHECK ON A DELETED POST THAT IS STILL BEING PURGED
+
+@router.get("/{id}/deletion", response_model=schemas.PostDeletion)
+def get_post_deletion(id: int, db: Session = Depends(get_db), current_user: int = Depends(
+                                                              oauth2.get_current_user)):
+
+    post = db.query(models.Post).filter(models.Post.id == id, models.Post.deleted_at.isnot(None)).first()
+
+    # Once the purge has finished the row is gone, so 404 here means 'fully deleted' (or never existed)
     if post == None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'post with id: {id} was not found')
-    
-    # If the current user is trying to delete a post made by someone else:
+                            detail=f'post with id: {id} is not waiting to be deleted')
+
     if post.user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail='You are not authorized to perform this action.')
-    
-    post_query.delete(synchronize_session=False)
-    db.commit()
 
-    return Response(status_code=status.HTTP_204_NO_CONTENT)
+    votes_remaining = db.query(func.count(models.Vote.post_id)).filter(models.Vote.post_id == id).scalar()
+    timelines_remaining = db.query(func.count(models.Timeline.post_id))\
+        .filter(models.Timeline.post_id == id, models.Timeline.post_created_at == post.created_at).scalar()
+
+    return {"post_id": post.id, "deleted_at": post.deleted_at, "votes_remaining": votes_remaining,
+            "timelines_remaining": timelines_remaining}
 
 # ----------------------------------------------------------------------------------------------------
 
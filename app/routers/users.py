@@ -1,12 +1,17 @@
-from .. import models, schemas, utils
+from .. import models, schemas, utils, oauth2, feeds
+from ..cache import user_cache
+from ..config import settings
 from ..database import engine, get_db
-from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter
+from ..routing import AppRoute
+from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter, Query
 from sqlalchemy.orm import Session
+from typing import List, Optional
 
 # Initialise the router, and how the decorators used to be app.get, change to router.get, or router.post, etc.
 router = APIRouter(
     prefix="/users",
-    tags=["Users"]
+    tags=["Users"],
+    route_class=AppRoute
 )
 
 # ----------------------------------------------------------------------------------------------------
@@ -27,13 +32,66 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
 
 # ----------------------------------------------------------------------------------------------------
 
+# GET MANY USERS IN ONE GO: {{URL}}users?ids=1,2,3
+# Clients showing post authors used to call GET /users/{id} once per author. This resolves the whole list
+# with one WHERE id IN (...) query, and only for the ids that aren't already in the user cache. Ids that
+# don't exist are left out of the response rather than raising a 404.
+
+@router.get("/", response_model=List[schemas.UserOut])
+def get_users(ids: str, db: Session = Depends(get_db)):
+
+    try:
+        user_ids = list(dict.fromkeys(int(id) for id in ids.split(',') if id.strip())) # drops duplicates
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail='ids must be a comma separated list of integers')
+
+    if len(user_ids) > settings.user_batch_max_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Cannot look up more than {settings.user_batch_max_ids} users at once')
+
+    found = {}
+    for id in user_ids:
+        cached = user_cache.get(id)
+        if cached is not None:
+            found[id] = cached
+
+    missing = [id for id in user_ids if id not in found]
+    if missing:
+        for user in db.query(models.User).filter(models.User.id.in_(missing)).all():
+            found[user.id] = schemas.UserOut.model_validate(user, from_attributes=True)
+            user_cache.set(user.id, found[user.id])
+
+    return [found[id] for id in user_ids if id in found]
+
+# ----------------------------------------------------------------------------------------------------
+
 @router.get("/{id}", response_model=schemas.UserOut)
 def get_user(id: int, db: Session = Depends(get_db)):
 
+    cached = user_cache.get(id)
+    if cached is not None:
+        return cached
+
     user = db.query(models.User).filter(models.User.id == id).first()
 
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail= f'User with id: {id} does not exist!')
     
-    return user
+    user_out = schemas.UserOut.model_validate(user, from_attributes=True)
+    user_cache.set(id, user_out)
+
+    return user_out
+
+# ----------------------------------------------------------------------------------------------------
+
+# ONE USER'S POSTS: {{URL}}users/3/posts?limit=20 -> newest first
+# NEXT PAGE: {{URL}}users/3/posts?limit=20&cursor=<next_cursor from the previous page>
+# Reads the (user_id, created_at, id) index on posts, so every page costs the same however far back you go.
+
+@router.get("/{id}/posts")
+def get_user_posts(id: int, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user),
+                   limit: int = Query(20, gt=0, le=settings.feed_max_limit), cursor: Optional[str] = None):
+
+    return feeds.author_timeline(db, id, limit, cursor)
@@ -1,17 +1,21 @@
 from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter
 from sqlalchemy.orm import Session
 from .. import schemas, database, models, oauth2
+from ..routing import AppRoute
+from ..cache import posts_cache
+from ..pubsub import vote_broker
 
 router = APIRouter(
     prefix='/vote',
-    tags=['Vote']
+    tags=['Vote'],
+    route_class=AppRoute
 )
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
 def vote(vote: schemas.Vote, db: Session = Depends(database.get_db), current_user: int = Depends(
                                                                      oauth2.get_current_user)):
     
-    post = db.query(models.Post).filter(models.Post.id == vote.post_id).first()
+    post = db.query(models.Post).filter(models.Post.id == vote.post_id, models.Post.deleted_at.is_(None)).first()
 
     # Check that post that is being liked exists in the first place
     if not post:
@@ -29,9 +33,11 @@ def vote(vote: schemas.Vote, db: Session = Depends(database.get_db), current_use
         if found_vote:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                                 detail=f'user {current_user.id} has already voted on post {vote.post_id}')
-        new_vote = models.Vote(post_id = vote.post_id, user_id=current_user.id)
+        new_vote = models.Vote(post_id = vote.post_id, post_created_at=post.created_at, user_id=current_user.id)
         db.add(new_vote)
         db.commit()
+        posts_cache.bump() # vote counts on cached GET /posts pages are out of date now
+        vote_broker.publish(vote.post_id) # pushes the new count to /posts/stream subscribers
         return {'message': 'successfully added vote'}
     
     # If the post is being un-liked
@@ -41,6 +47,8 @@ def vote(vote: schemas.Vote, db: Session = Depends(database.get_db), current_use
         
         vote_query.delete(synchronize_session=False)
         db.commit()
+        posts_cache.bump()
+        vote_broker.publish(vote.post_id)
 
         return {'message': 'successfully delete vote'}
     
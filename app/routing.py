@@ -0,0 +1,74 @@
+import functools
+import inspect
+from fastapi.routing import APIRoute
+from sqlalchemy.orm import Session
+from .profiling import attach_thread
+
+# NOTES:
+# - Every router uses AppRoute as its route_class, e.g. APIRouter(prefix='/posts', route_class=AppRoute).
+#   It wraps each endpoint function so we can do things right after the endpoint returns and before
+#   FastAPI turns the return value into JSON.
+# - RELEASING THE DATABASE CONNECTION EARLY: get_db gives every request a Session, but FastAPI only closes
+#   it after the whole response has been sent. A Session only checks out a connection from the pool when
+#   it runs its first query, but then keeps it until its transaction ends. Read-only endpoints never
+#   commit, so their connection stayed checked out while the response was serialized and written to the
+#   client, however slow that client was.
+# - So once the endpoint returns, we end the Session's transaction ourselves: commit if it returned
+#   normally (every endpoint commits its own writes, so this normally has nothing left to write), rollback
+#   if it raised. Ending the transaction hands the connection straight back to the pool.
+# - SessionLocal has expire_on_commit=False, so the objects the endpoint returns keep their loaded values
+#   after that commit and serializing them doesn't need the database again. If serialization does need to
+#   lazy load something, the Session quietly checks out a connection again and get_db closes it at the end.
+# - The wrapper also lets the sampling profiler (profiling.py) see the threadpool thread a sync endpoint
+#   runs on, when the request is being profiled.
+
+
+def end_transactions(kwargs, succeeded: bool):
+    for value in kwargs.values():
+        if isinstance(value, Session):
+            if succeeded:
+                value.commit()
+            else:
+                value.rollback()
+
+
+def release_connections_after(endpoint):
+
+    # app.include_router builds the routes again from our (already wrapped) endpoints, don't wrap twice
+    if getattr(endpoint, 'releases_connections', False):
+        return endpoint
+
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                result = await endpoint(*args, **kwargs)
+            except BaseException:
+                end_transactions(kwargs, succeeded=False)
+                raise
+            end_transactions(kwargs, succeeded=True)
+            return result
+        async_wrapper.releases_connections = True
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        try:
+            # Sync endpoints run on a threadpool thread, this lets the profiler sample it (profiling.py)
+            with attach_thread():
+                result = endpoint(*args, **kwargs)
+        except BaseException:
+            end_transactions(kwargs, succeeded=False)
+            raise
+        end_transactions(kwargs, succeeded=True)
+        return result
+    wrapper.releases_connections = True
+    return wrapper
+
+
+class AppRoute(APIRoute):
+
+    def __init__(self, path, endpoint, **kwargs):
+        # functools.wraps keeps the endpoint's signature, name and docstring, which is what FastAPI reads to
+        # work out the parameters, dependencies and the docs
+        super().__init__(path, release_connections_after(endpoint), **kwargs)
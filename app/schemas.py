@@ -29,6 +29,7 @@ class Post(PostBase):
     id: int
     created_at: datetime
     user_id: int
+    version: int
     user: UserOut
 
     # This has to be added so that Pydantic can convert a SQLAlchemy model to a Pydantic model, just memorise
@@ -44,6 +45,14 @@ class PostOut(PostBase):
         orm_mode = True
 
 
+# Progress of a post that has been deleted but not purged from the database yet
+class PostDeletion(BaseModel):
+    post_id: int
+    deleted_at: datetime
+    votes_remaining: int
+    timelines_remaining: int # home feed rows still pointing at the post, one per follower of the author
+
+
 # Create a new user
 class UserCreate(BaseModel):
     email: EmailStr
@@ -67,4 +76,9 @@ class TokenData(BaseModel):
 class Vote(BaseModel):
     post_id: int
     dir: conint(le=1) # imported from pydantic, less than or equal to 1, i.e. 0 or 1. 1 for like, 0 for 
-    # un-like. However, also includes negatives numbers, dunno if there's another way?
\ No newline at end of file
+    # un-like. However, also includes negatives numbers, dunno if there's another way?
+
+
+class Follow(BaseModel):
+    user_id: int
+    dir: conint(ge=0, le=1) # 1 to follow, 0 to unfollow
@@ -1,7 +1,14 @@
 from passlib.context import CryptContext
+from .config import settings
 
 # Tells passlib to use bcrypt as the default hashing algorithm to securely store user passwords in the database.
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated="auto") 
+# The bcrypt cost (rounds) comes from Settings. Every extra round doubles the time it takes to hash or verify,
+# so run 'python -m app.calibrate_bcrypt' on the server to pick a value. Setting min and max rounds to the same
+# value means any stored hash with a different cost 'needs updating', which is what lets login rehash it.
+pwd_context = CryptContext(schemes=['bcrypt'], deprecated="auto",
+                           bcrypt__default_rounds=settings.bcrypt_rounds,
+                           bcrypt__min_rounds=settings.bcrypt_rounds,
+                           bcrypt__max_rounds=settings.bcrypt_rounds)
 
 # Hashes the password
 def hash(password: str):
@@ -10,3 +17,8 @@ def hash(password: str):
 # Takes in the raw password, hashes, then compares to the database hashed password
 def verify(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
+
+# Same as verify, but also returns a new hash if the stored one was made with a different bcrypt cost
+# (otherwise None). Returns a tuple: (password matches, new hash or None)
+def verify_and_update(plain_password, hashed_password):
+    return pwd_context.verify_and_update(plain_password, hashed_password)
@@ -0,0 +1,75 @@
+"""Bandwidth vs CPU tradeoff of response compression at different levels.
+
+Builds a fake GET /posts page (same shape as the real response) and times gzip and brotli at each level.
+Doesn't need the database or a .env file, run it from the repo root:
+
+    python benchmarks/compression_bench.py
+    python benchmarks/compression_bench.py --posts 100 --repeat 50
+
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import string
+import time
+
+import brotli
+
+
+def fake_posts_page(n_posts: int):
+    random.seed(0)
+    words = [''.join(random.choices(string.ascii_lowercase, k=random.randint(3, 9))) for _ in range(500)]
+    page = []
+    for i in range(n_posts):
+        page.append({
+            "Post": {
+                "id": i,
+                "title": ' '.join(random.choices(words, k=6)),
+                "content": ' '.join(random.choices(words, k=80)),
+                "published": True,
+                "created_at": "2024-08-26T13:14:46.066111+00:00",
+                "user_id": random.randint(1, 50)
+            },
+            "votes": random.randint(0, 500)
+        })
+    return json.dumps(page).encode()
+
+
+def measure(compress, body: bytes, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        compressed = compress(body)
+    elapsed = (time.perf_counter() - start) / repeat
+    return len(compressed), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=10, help='posts per page (the default limit is 10)')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    body = fake_posts_page(args.posts)
+    print(f'uncompressed body: {len(body)} bytes ({args.posts} posts)\n')
+    print(f'{"encoding":<10}{"level":>6}{"bytes":>10}{"ratio":>8}{"ms/resp":>10}{"MB/s":>9}')
+
+    rows = [('gzip', level, lambda b, level=level: gzip.compress(b, compresslevel=level)) for level in range(1, 10)]
+    rows += [('br', quality, lambda b, quality=quality: brotli.compress(b, quality=quality))
+             for quality in range(0, 12)]
+
+    for encoding, level, compress in rows:
+        # brotli 10 and 11 are very slow, don't spend forever on them
+        repeat = max(1, args.repeat // 20) if encoding == 'br' and level >= 10 else args.repeat
+        size, elapsed = measure(compress, body, repeat)
+        print(f'{encoding:<10}{level:>6}{size:>10}{len(body) / size:>8.2f}{elapsed * 1000:>10.3f}'
+              f'{len(body) / elapsed / 1e6:>9.1f}')
+
+    # What a repeat hit costs when the compressed variant is already cached: just hashing the body
+    _, elapsed = measure(lambda b: hashlib.blake2b(b, digest_size=16).digest(), body, args.repeat)
+    print(f'\ncached variant (blake2b of body): {elapsed * 1000:.3f} ms/resp')
+
+
+if __name__ == '__main__':
+    main()